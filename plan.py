@@ -1,13 +1,44 @@
 import datetime
+import functools
+import math
 from enum import Enum
-from typing import List, Tuple, Optional
-from PIL import Image, ImageDraw, ImageFont
+from typing import Iterator, List, Tuple, Optional
+from PIL import Image, ImageColor, ImageDraw, ImageFont
 import numpy as np
-from icalendar import Calendar as ICalender, Event
+import cv2
+from icalendar import Event, vDate, vText
 
 
 GithubContributionLevels = 4
 
+@functools.lru_cache(maxsize=8)
+def _load_font(font_path: str, font_size: int) -> ImageFont.FreeTypeFont:
+    """Loads a TrueType font, reusing it across plans"""
+    return ImageFont.truetype(font_path, font_size)
+
+@functools.lru_cache(maxsize=4096)
+def _text_length(font_path: str, font_size: int, text: str) -> float:
+    """Returns the advance of a short run of text, such as a character or a pair of them"""
+    return _load_font(font_path, font_size).getlength(text)
+
+@functools.lru_cache(maxsize=512)
+def _render_glyph(font_path: str, font_size: int, char: str, start_x: float) -> Tuple[int, Image]:
+    """Renders a single character as a grayscale mask, offset by the fractional part of its pen position.
+    Returns the horizontal offset of the mask from the pen position and the mask itself"""
+    font = _load_font(font_path, font_size)
+    left, _, right, bottom = font.getbbox(char)
+    left = min(left, 0)
+    height = max(bottom, sum(font.getmetrics()))
+    glyph = Image.new('L', (max(right - left, 0) + 1, height), "black")
+    ImageDraw.Draw(glyph).text((start_x - left, 0), char, fill="white", font=font)
+    return left, glyph
+
+def _ical_date(date: datetime.date) -> vDate:
+    """Wraps a date as an all-day iCalendar value, as Event.add() would"""
+    value = vDate(date)
+    value.params['VALUE'] = 'DATE'
+    return value
+
 class Mode(Enum):
     """Mode for the GitHubPlanner colors"""
     DEPTH = "depth"
@@ -15,71 +46,72 @@ class Mode(Enum):
     
 class Calendar:
     """Represents a GitHub contribution calendar"""    
+    # Colors for the different levels of contributions (GitHub color scheme), parsed once
+    _PALETTE_RGB = np.array(
+        [ImageColor.getrgb(c) for c in ("#ebedf0", "#9be9a8", "#40c463", "#30a14e", "#216e39")],
+        dtype=np.uint8)
+
     def __init__(self, year: int, plan_matrix: np.ndarray):
         self._year = year
         self._matrix = plan_matrix
     
-    def _get_first_sunday(self) -> datetime:
-        """Returns the first Sunday of the year"""
+    @functools.cached_property
+    def _first_sunday(self) -> datetime.datetime:
+        """The first Sunday of the year"""
         date = datetime.datetime(self._year, 1, 1)
         # Calculate how many days to add to get to the first Sunday
         days_to_add = (6 - date.weekday()) % 7  # weekday() returns 0 for Monday, 6 for Sunday
         first_sunday = date + datetime.timedelta(days=days_to_add)
         return first_sunday
     
+    def iter_contribution_days(self) -> Iterator[Tuple[datetime.datetime, int]]:
+        """Yields the date and contribution level of every day with contributions"""
+        start_date = np.datetime64(self._first_sunday.date())
+        # Cells are laid out week by week (columns), so flatten the matrix column-major
+        # to line each level up with its day offset from the first Sunday
+        levels = self._matrix.ravel(order='F')
+        dates = start_date + np.arange(levels.size).astype('timedelta64[D]')
+        mask = levels != 0
+        # Only convert back to Python objects at the boundary
+        yield from zip(dates[mask].astype('datetime64[s]').tolist(), levels[mask].tolist())
+
     def get_contribution_days(self) -> List[Tuple[datetime.datetime, int]]:
-        start_date = self._get_first_sunday()
-        contribution_days = []
-        # Calculate the date for each contribution in the matrix
-        for week in range(self._matrix.shape[1]):  # Iterate over weeks (columns)
-            for day in range(self._matrix.shape[0]):  # Iterate over days (rows)
-                if self._matrix[day, week] == 0:
-                    continue
-                # Calculate the date for this cell
-                current_date = start_date + datetime.timedelta(days=week*7 + day)
-                # Append the date and contribution level to the list
-                contribution_days.append((current_date, self._matrix[day, week]))
-
-        return contribution_days
+        return list(self.iter_contribution_days())
     
     def to_image(self, cell_size: int = 20, padding: int = 2) -> Image:
         """Creates an image representing the contribution calendar"""
-        # Define colors for different levels of contributions (feel free to adjust)
-        colors = ["#ebedf0", "#9be9a8", "#40c463", "#30a14e", "#216e39"]  # GitHub color scheme
-
         # Calculate the size of the full image
         width = cell_size * self._matrix.shape[1] + padding * (self._matrix.shape[1] - 1)
         height = cell_size * self._matrix.shape[0] + padding * (self._matrix.shape[0] - 1)
-        image = Image.new('RGB', (width, height), color=colors[0])
-        draw = ImageDraw.Draw(image)
 
-        # Draw each cell
-        for row in range(self._matrix.shape[0]):
-            for col in range(self._matrix.shape[1]):
-                contribution_level = self._matrix[row, col]
-                color = colors[contribution_level]
-
-                # Calculate position and size of each cell
-                top_left = (col * (cell_size + padding), row * (cell_size + padding))
-                bottom_right = (top_left[0] + cell_size, top_left[1] + cell_size)
-                draw.rectangle([top_left, bottom_right], fill=color)
-
-        return image
+        # Color every cell once, with an extra background row and column for the padding
+        rows, cols = self._matrix.shape
+        cells = np.full((rows + 1, cols + 1, 3), self._PALETTE_RGB[0], dtype=np.uint8)
+        cells[:rows, :cols] = self._PALETTE_RGB[self._matrix]
+
+        # Map each pixel coordinate to its cell, or to the background when it falls
+        # in the padding between cells (cells span cell_size + 1 pixels)
+        step = cell_size + padding
+        ys, xs = np.arange(height), np.arange(width)
+        ys = np.where(ys % step <= cell_size, ys // step, rows)
+        xs = np.where(xs % step <= cell_size, xs // step, cols)
+
+        # Expand the cells to pixels one axis at a time, columns first so that
+        # expanding the rows copies whole contiguous pixel rows
+        return Image.fromarray(cells.take(xs, axis=1).take(ys, axis=0))
     
     def save_icalendar(self, file_name: str='contributions.ics') -> str:
-        # Create a calendar
-        cal = ICalender()
-
-        for day, contribution in self.get_contribution_days():
-            event = Event()
-            event.add('summary', f'Make {contribution} contributions')
-            event.add('dtstart', day.date())
-            event.add('dtend', (day + datetime.timedelta(days=1)).date())
-            cal.add_component(event)
-
-        # Write the calendar to an ics file
+        # Write the calendar to an ics file, one event at a time between the calendar delimiters
         with open(file_name, 'wb') as f:
-            f.write(cal.to_ical())
+            f.write(b'BEGIN:VCALENDAR\r\n')
+            for day, contribution in self.iter_contribution_days():
+                # Assign already typed properties to skip the type inference of Event.add()
+                event = Event()
+                event['SUMMARY'] = vText(f'Make {contribution} contributions')
+                event['DTSTART'] = _ical_date(day.date())
+                event['DTEND'] = _ical_date((day + datetime.timedelta(days=1)).date())
+                f.write(event.to_ical())
+            f.write(b'END:VCALENDAR\r\n')
 
         return file_name
 
@@ -93,60 +125,89 @@ class GitHubPlanner:
         """Creates a calendar with the given text"""
         if year is None:
             year = datetime.now().year
-            
+
+        # Blank text plans no contributions, skip rendering it
+        if not text.strip():
+            return Calendar(year, np.zeros((7, 52), dtype=np.uint8))
+
         ascii_image = self._text_to_image(text)
         contribution_matrix = self._image_to_contribution(ascii_image)
         
         return Calendar(year, contribution_matrix)
 
-    def _text_to_image(self, text: str) -> Image:
-        """Converts text to a black and white image"""
+    def _text_to_image(self, text: str) -> np.ndarray:
+        """Converts text to a black and white grayscale array"""
         image_mode = 'L' if self.mode == Mode.DEPTH else '1'
-        font = ImageFont.truetype(self.font_path, self._font_size)
+        font = _load_font(self.font_path, self._font_size)
         dummy_image = Image.new(image_mode, (1, 1))
         dummy_draw = ImageDraw.Draw(dummy_image)
         width, height = dummy_draw.textbbox((0,0), text, font=font, spacing=10, align='center')[2:]
         image = Image.new(image_mode, (width, height), "black")
-        draw = ImageDraw.Draw(image)
-        draw.text((0, 0), text, fill="white", font=font, spacing=10)
-
-        # Crop the image to remove unnecessary whitespace
-        # Find the bounding box of the non-white area
-        bbox = image.getbbox()
-        if bbox:
-            image = image.crop(bbox)
-        return image
-
-    def _image_to_contribution(self, image: Image, size: Tuple[int, int]=(52,7)) -> np.ndarray:
+        if self._can_compose_glyphs(text, font):
+            # Compose the text from cached glyphs, blending overlaps the way Pillow does for a whole string
+            pen_x = 0.0
+            for char in text:
+                start_x, x = math.modf(pen_x)
+                left, glyph = _render_glyph(self.font_path, self._font_size, char, start_x)
+                box = (int(x) + left, 0, int(x) + left + glyph.width, glyph.height)
+                image.paste("white", box, glyph)
+                pen_x += _text_length(self.font_path, self._font_size, char)
+        else:
+            draw = ImageDraw.Draw(image)
+            draw.text((0, 0), text, fill="white", font=font, spacing=10)
+
+        img_array = np.asarray(image if image.mode == 'L' else image.convert('L'))
+
+        # Crop the array to remove unnecessary whitespace
+        # Find the bounding box of the non-black area
+        rows, cols = np.flatnonzero(img_array.any(axis=1)), np.flatnonzero(img_array.any(axis=0))
+        if rows.size:
+            img_array = img_array[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+        return img_array
+
+    def _can_compose_glyphs(self, text: str, font: ImageFont.FreeTypeFont) -> bool:
+        """Checks whether composing cached glyphs renders the text exactly like a single draw call"""
+        # Bilevel glyphs are positioned differently when rendered on their own, while
+        # multiline and shaped text isn't laid out glyph by glyph
+        if self.mode != Mode.DEPTH or '\n' in text or font.layout_engine != ImageFont.Layout.BASIC:
+            return False
+        # Kerning only applies between neighbouring characters
+        length = functools.partial(_text_length, self.font_path, self._font_size)
+        for first, second in zip(text, text[1:]):
+            if length(first) + length(second) != length(first + second):
+                return False
+        return True
+
+    def _image_to_contribution(self, image: np.ndarray, size: Tuple[int, int]=(52,7)) -> np.ndarray:
         # Calculate the aspect ratio of the original image
-        aspect_ratio = image.width / image.height
+        aspect_ratio = image.shape[1] / image.shape[0]
 
         # Calculate new dimensions based on aspect ratio
         new_height = int(size[1])
-        new_width = min(int(new_height * aspect_ratio), size[0])
+        new_width = max(min(int(new_height * aspect_ratio), size[0]), 1)
 
-        # Resize image to fit GitHub contributions while maintaining aspect ratio
-        img_resized = image.resize((new_width, new_height), Image.LANCZOS)
+        # Resize image to fit GitHub contributions while maintaining aspect ratio,
+        # area averaging suits the heavy downscaling from the text bitmap
+        img_resized = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_AREA)
 
-        # Create a new blank image with the target size
-        final_img = Image.new('L', size, color='black')
         # Calculate top-left position to paste the resized image for centering
         paste_x = (size[0] - new_width) // 2
         paste_y = (size[1] - new_height) // 2
 
-        # Paste the resized image onto the center of the blank image
-        final_img.paste(img_resized, (paste_x, paste_y))
-
-        # Convert image to numpy array
-        img_array = np.array(final_img)
+        # Paste the resized image onto the center of a blank array with the target size
+        img_array = np.zeros((size[1], size[0]), dtype=np.uint8)
+        img_array[paste_y:paste_y + new_height, paste_x:paste_x + new_width] = img_resized
 
         # Normalizing the array to have values between 0 and 4
         min_val, max_val = img_array.min(), img_array.max()
         if min_val == max_val:
-            return np.zeros_like(img_array)
-        max_level = GithubContributionLevels if self.mode == Mode.DEPTH else 1
-        normalized_array = (img_array - min_val) / (max_val - min_val) * max_level
-        contribution_matrix = np.rint(normalized_array).astype(int)
+            return np.zeros_like(img_array, dtype=np.uint8)
+        if self.mode == Mode.PLAIN:
+            # A single level rounds to 1 only above the middle of the value range
+            return (img_array > (int(min_val) + int(max_val)) / 2).astype(np.uint8)
+        # Normalize through a lookup table over the pixel values instead of the whole array
+        levels = np.rint(np.arange(int(max_val) - int(min_val) + 1) / (max_val - min_val) * GithubContributionLevels).astype(np.uint8)
+        contribution_matrix = levels[img_array - min_val]
 
         return contribution_matrix
 